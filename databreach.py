@@ -1,14 +1,23 @@
 import requests
-import xml.etree.ElementTree as ET
-import json
+import aiohttp
+import asyncio
+import hashlib
+import html
+import io
 import os
 import smtplib
 import logging
+import re
 import sys
+import orjson
 from datetime import datetime, timezone
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from functools import lru_cache
+from pathlib import Path
+from logging.handlers import MemoryHandler
+from email.message import EmailMessage
+from email import policy
 from dotenv import load_dotenv
+from lxml import etree
 
 # =====================================================
 # LOAD ENV
@@ -34,24 +43,84 @@ file_handler.setFormatter(
     logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
 )
 
+class BatchedMemoryHandler(MemoryHandler):
+    """MemoryHandler that drains its buffer with one write() and one flush()."""
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.target is None or not self.buffer:
+                return
+            target = self.target
+            data = "".join(
+                target.format(record) + target.terminator for record in self.buffer
+            )
+            target.acquire()
+            try:
+                target.stream.write(data)
+                target.flush()
+            finally:
+                target.release()
+            self.buffer.clear()
+        finally:
+            self.release()
+
+# Buffer file writes; flushed on ERROR, every 100 records, and at the end of
+# main(). The small capacity bounds what a killed job can lose.
+memory_handler = BatchedMemoryHandler(
+    capacity=100, flushLevel=logging.ERROR, target=file_handler
+)
+
 logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+logger.addHandler(memory_handler)
 
 # =====================================================
 # CONFIG
 # =====================================================
 SITEMAP_URL = "https://www.breachsense.com/sitemap.xml"
+# Extra sitemap shards (sitemap-1.xml, ...) fetched concurrently, if any
+SITEMAP_SHARDS = [
+    u.strip() for u in os.getenv("SITEMAP_SHARDS", "").split(",") if u.strip()
+]
+SHARD_CONCURRENCY = 10
 BREACH_PREFIX = "https://www.breachsense.com/breaches/"
 
-MASTER_FILE = "breachsense_master.json"
+# "regex" switches to the byte-level fast parser; set
+# SITEMAP_PARSER_VALIDATE=1 for one run after a deploy to cross-check it
+# against the XML parser (it parses the sitemap twice)
+SITEMAP_PARSER = os.getenv("SITEMAP_PARSER", "xml")
+SITEMAP_PARSER_VALIDATE = os.getenv("SITEMAP_PARSER_VALIDATE") == "1"
+
+# Namespace-qualified tag names, resolved once and compared directly in
+# parse_sitemap (no per-element path or prefix lookup)
+SITEMAP_NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+URL_TAG = SITEMAP_NS + "url"
+LOC_TAG = SITEMAP_NS + "loc"
+LASTMOD_TAG = SITEMAP_NS + "lastmod"
+
+# Finds the prefix (if any) bound to the sitemap namespace
+SITEMAP_XMLNS_RE = re.compile(
+    rb"xmlns(?::([\w.-]+))?\s*=\s*[\"']"
+    + re.escape(SITEMAP_NS[1:-1].encode())
+    + rb"[\"']"
+)
+XML_COMMENT_RE = re.compile(rb"<!--.*?-->", re.DOTALL)
+
+MASTER_FILE = "breachsense_master.jsonl"
+LEGACY_MASTER_FILE = "breachsense_master.json"
 DAILY_FILE = "breachsense_daily.json"
+STATE_FILE = "breachsense_state.json"
 
 MAX_LINKS_PER_EMAIL = 40
 
 HEADERS = {
-    "User-Agent": "Mozilla/5.0 (compatible; BreachSenseDailyScraper/1.0)"
+    "User-Agent": "Mozilla/5.0 (compatible; BreachSenseDailyScraper/1.0)",
+    "Accept-Encoding": "gzip"
 }
 
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
 # =====================================================
 # SMTP / EMAIL CONFIG (ENV)
 # =====================================================
@@ -75,35 +144,144 @@ if not EMAIL_TO:
 # =====================================================
 # FETCH SITEMAP
 # =====================================================
-def fetch_sitemap():
+def fetch_sitemap(state):
+    """Conditional GET; returns None if the sitemap is unchanged (HTTP 304).
+
+    On a fresh response the new ETag / Last-Modified validators are written
+    back into ``state`` so the caller can persist them after a successful run.
+    """
     logger.info(f"Fetching sitemap: {SITEMAP_URL}")
-    response = requests.get(SITEMAP_URL, headers=HEADERS, timeout=30)
+
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    response = SESSION.get(SITEMAP_URL, headers=headers, timeout=30)
+    if response.status_code == 304:
+        logger.info("Sitemap not modified since last run (HTTP 304)")
+        return None
     response.raise_for_status()
+
+    logger.info(
+        f"Sitemap downloaded | {len(response.content)} bytes | "
+        f"Content-Encoding: {response.headers.get('Content-Encoding', 'identity')}"
+    )
+    state["etag"] = response.headers.get("ETag")
+    state["last_modified"] = response.headers.get("Last-Modified")
     return response.content
 
+async def fetch_all(urls):
+    connector = aiohttp.TCPConnector(limit=20)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(
+        headers=HEADERS, connector=connector, timeout=timeout
+    ) as session:
+        sem = asyncio.Semaphore(SHARD_CONCURRENCY)
+
+        async def fetch_one(url):
+            async with sem, session.get(url) as response:
+                response.raise_for_status()
+                return await response.read()
+
+        return await asyncio.gather(*map(fetch_one, urls))
+
+def fetch_shards(urls):
+    logger.info(f"Fetching {len(urls)} sitemap shard(s) concurrently")
+    return asyncio.run(fetch_all(urls))
+
 # =====================================================
 # PARSE SITEMAP
 # =====================================================
 def parse_sitemap(xml_data):
-    root = ET.fromstring(xml_data)
-    ns = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+    """Return ``(url, lastmod)`` tuples for breach URLs in the sitemap."""
+    if SITEMAP_PARSER != "regex":
+        return parse_sitemap_xml(xml_data)
+
+    results = parse_sitemap_regex(xml_data)
+    if SITEMAP_PARSER_VALIDATE:
+        expected = parse_sitemap_xml(xml_data)
+        if results != expected:
+            logger.warning(
+                f"Regex sitemap parser mismatch | regex: {len(results)} | "
+                f"xml: {len(expected)} — using XML result"
+            )
+            return expected
+        logger.info("Regex sitemap parser validated against XML parser")
+    return results
 
-    results = []
-    for url in root.findall("sm:url", ns):
-        loc = url.find("sm:loc", ns)
-        lastmod = url.find("sm:lastmod", ns)
+@lru_cache(maxsize=None)
+def sitemap_regexes(prefix):
+    """Compile the <url>, <loc> and <lastmod> patterns for a namespace prefix."""
+    p = re.escape(prefix + b":") if prefix else b""
+    url_re = re.compile(
+        rb"<" + p + rb"url(?:\s[^>]*)?>(.*?)</" + p + rb"url\s*>", re.DOTALL
+    )
+    loc_re = re.compile(rb"<" + p + rb"loc\s*>([^<]*)</" + p + rb"loc\s*>")
+    lastmod_re = re.compile(
+        rb"<" + p + rb"lastmod\s*(?:/>|>([^<]*)</" + p + rb"lastmod\s*>)"
+    )
+    return url_re, loc_re, lastmod_re
+
+def parse_sitemap_regex(xml_data):
+    # CDATA sections are rare in sitemaps; let the XML parser handle them
+    if b"<![CDATA[" in xml_data:
+        return parse_sitemap_xml(xml_data)
+    if b"<!--" in xml_data:
+        xml_data = XML_COMMENT_RE.sub(b"", xml_data)
+
+    match = SITEMAP_XMLNS_RE.search(xml_data)
+    if match is None:
+        return []
+    url_re, loc_re, lastmod_re = sitemap_regexes(match.group(1) or b"")
 
-        if loc is None or not loc.text:
+    results = []
+    for block in url_re.findall(xml_data):
+        # Children may appear in any order, so look each one up in the block
+        loc = loc_re.search(block)
+        if loc is None:
+            continue
+        link = html.unescape(loc.group(1).decode()).strip()
+        if not link or not link.startswith(BREACH_PREFIX):
             continue
 
-        link = loc.text.strip()
-        if not link.startswith(BREACH_PREFIX):
+        lastmod = lastmod_re.search(block)
+        if lastmod is not None:
+            lastmod = html.unescape((lastmod.group(1) or b"").decode()).strip()
+        results.append((link, lastmod))
+
+    return results
+
+def parse_sitemap_xml(xml_data):
+    results = []
+    for _, elem in etree.iterparse(
+        io.BytesIO(xml_data), events=("end",), tag=URL_TAG
+    ):
+        # Single pass over the children instead of one path lookup per field
+        loc = lastmod = None
+        for child in elem:
+            if child.tag == LOC_TAG and loc is None:
+                loc = child.text or ""
+            elif child.tag == LASTMOD_TAG and lastmod is None:
+                lastmod = child.text or ""
+
+        # Free the processed <url> and any siblings already handled
+        elem.clear(keep_tail=False)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+        # Test the prefix on the raw text; strip() only the survivors, or
+        # padded values whose first character is whitespace
+        if not loc or not (
+            loc.startswith(BREACH_PREFIX)
+            or (loc[0].isspace() and loc.strip().startswith(BREACH_PREFIX))
+        ):
             continue
 
-        results.append({
-            "url": link,
-            "lastmod": lastmod.text.strip() if lastmod is not None else None
-        })
+        results.append(
+            (loc.strip(), lastmod.strip() if lastmod is not None else None)
+        )
 
     return results
 
@@ -114,39 +292,154 @@ def load_json(path):
     if not os.path.exists(path):
         return []
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            return json.loads(content) if content else []
-    except json.JSONDecodeError:
+        content = Path(path).read_bytes().strip()
+        return orjson.loads(content) if content else []
+    except orjson.JSONDecodeError:
         logger.warning(f"{path} invalid JSON — reinitializing")
         return []
 
 def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    # Write to a temp file and rename over the target so a crash mid-write
+    # never leaves a truncated JSON file behind
+    data_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data_bytes)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 # =====================================================
-# EMAIL
+# MASTER HISTORY (APPEND-ONLY JSONL)
 # =====================================================
-def send_email(subject, body):
-    logger.info("📧 Preparing email")
+def load_master():
+    """Yield master records; later lines for a URL supersede earlier ones.
+
+    Falls back to the legacy single-document JSON master if the JSONL log
+    does not exist yet.
+    """
+    if not os.path.exists(MASTER_FILE):
+        yield from load_json(LEGACY_MASTER_FILE)
+        return
+
+    with open(MASTER_FILE, "rb") as f:
+        for lineno, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                logger.warning(f"{MASTER_FILE}:{lineno} invalid JSON — skipping")
+
+def load_master_index():
+    """Load master history into parallel arrays plus a url → row index."""
+    urls, lastmods, scraped_dates = [], [], []
+    url_index = {}
+    for item in load_master():
+        url = item["url"]
+        idx = url_index.get(url)
+        if idx is None:
+            url_index[url] = len(urls)
+            urls.append(url)
+            lastmods.append(item.get("lastmod"))
+            scraped_dates.append(item.get("scraped_date"))
+        else:
+            lastmods[idx] = item.get("lastmod")
+            scraped_dates[idx] = item.get("scraped_date")
+    return urls, lastmods, scraped_dates, url_index
+
+def master_record(urls, lastmods, scraped_dates, idx):
+    return {
+        "url": urls[idx],
+        "lastmod": lastmods[idx],
+        "scraped_date": scraped_dates[idx]
+    }
+
+def trim_partial_line(path):
+    """Drop a trailing record left half-written by an interrupted append."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b"\n":
+            return
 
-    msg = MIMEMultipart()
-    msg["From"] = EMAIL_FROM
-    msg["To"] = ", ".join(EMAIL_TO)
-    msg["Subject"] = subject
-    msg.attach(MIMEText(body, "plain"))
+        # Scan backwards for the end of the last complete line
+        pos = end
+        keep = 0
+        while pos > 0:
+            step = min(64 * 1024, pos)
+            pos -= step
+            f.seek(pos)
+            nl = f.read(step).rfind(b"\n")
+            if nl != -1:
+                keep = pos + nl + 1
+                break
+
+        logger.warning(f"{path} ends with a partial record — truncating")
+        f.truncate(keep)
+
+def append_master(records):
+    trim_partial_line(MASTER_FILE)
+    with open(MASTER_FILE, "ab", buffering=1024 * 1024) as f:
+        f.writelines(orjson.dumps(r) + b"\n" for r in records)
+        f.flush()
+        os.fsync(f.fileno())
 
+# =====================================================
+# EMAIL
+# =====================================================
+def open_smtp():
+    """Return an authenticated SMTP connection, usable as a context manager."""
     logger.info("🔌 Connecting to SMTP server")
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as server:
+    server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+    try:
         server.ehlo()
         server.starttls()
         server.ehlo()
         server.login(SMTP_USER, SMTP_PASSWORD)
-        server.sendmail(EMAIL_FROM, EMAIL_TO, msg.as_string())
+    except Exception:
+        server.close()
+        raise
+    return server
 
+def build_email(subject, body):
+    """Serialize a plain-text report email to wire-ready bytes."""
+    msg = EmailMessage(policy=policy.SMTP)
+    msg["From"] = EMAIL_FROM
+    msg["To"] = ", ".join(EMAIL_TO)
+    msg["Subject"] = subject
+    # 7-bit safe for servers without 8BITMIME, like the old MIMEText
+    msg.set_content(body, cte="quoted-printable")
+    return msg.as_bytes()
+
+def send_one(server, msg_bytes):
+    server.sendmail(EMAIL_FROM, EMAIL_TO, msg_bytes)
     logger.info("✅ Email sent successfully")
 
+def send_email(subject, body):
+    logger.info("📧 Preparing email")
+    msg_bytes = build_email(subject, body)
+    with open_smtp() as server:
+        send_one(server, msg_bytes)
+
+def no_new_links_body(current_date):
+    return (
+        f"Date: {current_date}\n\n"
+        "✅ No new BreachSense breach URLs were found today.\n\n"
+        "This is an automated daily status email."
+    )
+
+def scrape_digest(scraped_today):
+    """BLAKE2b over the sorted (url, lastmod) pairs of a scrape."""
+    h = hashlib.blake2b(digest_size=16)
+    for url, lastmod in sorted((u, m or "") for u, m in scraped_today):
+        h.update(f"{url}\t{lastmod}\n".encode())
+    return h.hexdigest()
+
 def chunk_list(items, size):
     for i in range(0, len(items), size):
         yield items[i:i + size]
@@ -161,39 +454,92 @@ def main():
         current_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
         logger.info(f"Run date (UTC): {current_date}")
 
-        scraped_today = parse_sitemap(fetch_sitemap())
+        subject = f"📊 BreachSense Daily Scrape Report | {current_date}"
+
+        state = load_json(STATE_FILE) or {}
+        xml_data = fetch_sitemap(state)
+
+        # =================================================
+        # CASE 0: SITEMAP UNCHANGED → SEND STATUS EMAIL
+        # =================================================
+        if xml_data is None and not SITEMAP_SHARDS:
+            send_email(subject, no_new_links_body(current_date))
+            logger.info("📧 Sent no-new-links status email")
+            return
+
+        scraped_today = parse_sitemap(xml_data) if xml_data is not None else []
+        if SITEMAP_SHARDS:
+            for shard_data in fetch_shards(SITEMAP_SHARDS):
+                scraped_today.extend(parse_sitemap(shard_data))
         logger.info(f"Sitemap parsed | URLs found: {len(scraped_today)}")
 
-        master_data = load_json(MASTER_FILE)
-        master_map = {item["url"]: item for item in master_data}
-        logger.info(f"Master JSON loaded | Records: {len(master_data)}")
+        # =================================================
+        # CASE 0b: SAME URLS + LASTMODS AS LAST RUN → STATUS EMAIL
+        # =================================================
+        # Shards are always fetched in full and carry no ETag state. On a
+        # main-sitemap 304 the scrape covers only the shards, so it is
+        # diffed as usual but neither checked against nor stored as the
+        # digest, which always describes a full scrape.
+        full_scrape = xml_data is not None
+        digest = scrape_digest(scraped_today) if full_scrape else None
+        if full_scrape and digest == state.get("digest"):
+            logger.info("Sitemap content unchanged since last run (digest match)")
+            save_json(STATE_FILE, state)
+            send_email(subject, no_new_links_body(current_date))
+            logger.info("📧 Sent no-new-links status email")
+            return
+        if full_scrape:
+            state["digest"] = digest
+
+        migrating = not os.path.exists(MASTER_FILE)
+        urls, lastmods, scraped_dates, url_index = load_master_index()
+        master_count = len(urls)
+        logger.info(f"Master history loaded | Records: {master_count}")
+
+        # Diff via set algebra on the URL keys instead of a per-item branch
+        scraped_by_url = dict(scraped_today)
+        new_urls = scraped_by_url.keys() - url_index.keys()
+        known_urls = scraped_by_url.keys() & url_index.keys()
+
+        # Keep sitemap order for the report
+        new_links = [
+            {"url": url, "lastmod": lastmod, "scraped_date": current_date}
+            for url, lastmod in scraped_by_url.items() if url in new_urls
+        ]
+        for item in new_links:
+            url_index[item["url"]] = len(urls)
+            urls.append(item["url"])
+            lastmods.append(item["lastmod"])
+            scraped_dates.append(current_date)
 
-        new_links = []
         updated_links = []
-
-        for item in scraped_today:
-            url = item["url"]
-            lastmod = item["lastmod"]
-
-            if url not in master_map:
-                new_links.append({
-                    "url": url,
-                    "lastmod": lastmod,
-                    "scraped_date": current_date
-                })
-            else:
-                old_lastmod = master_map[url].get("lastmod")
-                if lastmod and lastmod != old_lastmod:
-                    master_map[url]["lastmod"] = lastmod
-                    master_map[url]["scraped_date"] = current_date
-                    updated_links.append(url)
+        append_updated = updated_links.append
+        for url in known_urls:
+            idx = url_index[url]
+            lastmod = scraped_by_url[url]
+            if lastmod and lastmod != lastmods[idx]:
+                lastmods[idx] = lastmod
+                scraped_dates[idx] = current_date
+                append_updated(url)
+        # Stable order for the daily file; only the few updates are sorted
+        updated_links.sort()
 
         logger.info(
             f"Comparison complete | New: {len(new_links)} | Updated: {len(updated_links)}"
         )
 
-        master_data.extend(new_links)
-        save_json(MASTER_FILE, master_data)
+        if migrating:
+            # First JSONL write: seed the log with the full legacy history
+            master_records = [
+                master_record(urls, lastmods, scraped_dates, idx)
+                for idx in range(master_count)
+            ] + new_links
+        else:
+            master_records = new_links + [
+                master_record(urls, lastmods, scraped_dates, url_index[url])
+                for url in updated_links
+            ]
+        append_master(master_records)
 
         save_json(DAILY_FILE, {
             "date": current_date,
@@ -204,20 +550,15 @@ def main():
             "updated_links": updated_links
         })
 
-        logger.info("JSON files saved")
+        save_json(STATE_FILE, state)
 
-        subject = f"📊 BreachSense Daily Scrape Report | {current_date}"
+        logger.info("JSON files saved")
 
         # =================================================
         # CASE 1: NO NEW LINKS → SEND STATUS EMAIL
         # =================================================
         if not new_links:
-            body = (
-                f"Date: {current_date}\n\n"
-                "✅ No new BreachSense breach URLs were found today.\n\n"
-                "This is an automated daily status email."
-            )
-            send_email(subject, body)
+            send_email(subject, no_new_links_body(current_date))
             logger.info("📧 Sent no-new-links status email")
             return
 
@@ -226,6 +567,8 @@ def main():
         # =================================================
         chunks = list(chunk_list(new_links, MAX_LINKS_PER_EMAIL))
 
+        logger.info(f"📧 Preparing {len(chunks)} email(s)")
+        messages = []
         for idx, chunk in enumerate(chunks, start=1):
             body_lines = [
                 f"Date: {current_date}",
@@ -234,7 +577,12 @@ def main():
                 ""
             ]
             body_lines.extend(f"- {n['url']}" for n in chunk)
-            send_email(subject, "\n".join(body_lines))
+            messages.append(build_email(subject, "\n".join(body_lines)))
+
+        # One SMTP session (EHLO + STARTTLS + AUTH) for all parts
+        with open_smtp() as server:
+            for msg_bytes in messages:
+                send_one(server, msg_bytes)
 
         logger.info(f"📧 Sent {len(chunks)} email(s)")
 